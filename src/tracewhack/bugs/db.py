@@ -6,14 +6,31 @@ Talks to remote bug databases and caches information locally.
 
 from collections import defaultdict
 from os import path
-import shelve
+import Queue
+import threading
+import time
 
 from tracewhack import config, log
-from tracewhack.bugs import github
 
-SUPPORTED_DB_TYPES = {'github': github}
+# Backend modules are imported on demand (see _db_module), so that
+# cache-only queries never pay for the network libraries they pull in.
+SUPPORTED_DB_TYPES = {'github': 'tracewhack.bugs.github'}
 
-VERSION = 1
+VERSION = 2
+
+# The bug index holds, for each bug key, the few fields filters look
+# at, so filtered queries don't unpickle excluded bugs.  It's sharded
+# by (repo, state), one shelf key per shard, so queries filtering on
+# repo or state only load the matching shards; the set of shards is
+# kept under INDEX_SHARDS_KEY.
+INDEX_SHARDS_KEY = 'idx:shards'
+INDEX_SHARD_KEY_PREFIX = 'idx:bugs:'
+
+# Prefix of shelf keys for feedback, i.e. bugs confirmed or rejected as
+# matches for a traceback fingerprint (see tb.fingerprint).  One key per
+# fingerprint keeps lookups a single hashed read however many
+# fingerprints are recorded.
+FEEDBACK_KEY_PREFIX = 'fb:'
 
 
 class BugDb(object):
@@ -21,19 +38,38 @@ class BugDb(object):
     Aggregated database for formatted bugs.
     """
 
-    def __init__(self, profile, db_configs, options):
+    def __init__(self, profile, db_configs, options, writable=False):
         self.db_configs = db_configs
         self.cache_fname = _cache_fname(profile)
         self.options = options
+        self.writable = writable
         self.cache_shelf = None
 
-    def bugs(self):
+    def bugs(self, filters=None, keys=None):
         """
-        Generator to walk all the bugs in the bug db.
+        Generator to walk all the bugs in the bug db, or only those
+        with the given keys (global ids).
+
+        If filters are given (see matches_filters), only the bugs whose
+        index entries match them are loaded from the cache.
         """
-        for (key, val) in self.cache_shelf.iteritems():
+        if filters and any(filters.values()):
+            index = _load_index(self.cache_shelf, filters)
+            if keys is None:
+                keys = index.keys()
+            keys = [key for key in keys
+                    if key in index and matches_filters(index[key], filters)]
+
+        if keys is None:
+            # pick out the bug keys before loading anything, so we
+            # don't unpickle the index or feedback.
+            keys = self.cache_shelf.keys()
+        else:
+            keys = [key for key in keys if key in self.cache_shelf]
+
+        for key in keys:
             if _is_bug_key(key):
-                val = val.copy()
+                val = self.cache_shelf[key].copy()
                 val['global_id'] = key
                 yield val
 
@@ -42,14 +78,26 @@ class BugDb(object):
         Open the bug db, refreshing from remote dbs as specified by
         the refresh option.
         """
-        self.cache_shelf = _open_cache_shelf(self.cache_fname)
+        readonly = self.options['refresh'] == 'none' and not self.writable
+        self.cache_shelf = _open_cache_shelf(self.cache_fname,
+                                             readonly=readonly)
 
         if not self.cache_shelf.get('version', None):
             # new shelf
             self.cache_shelf['version'] = VERSION
 
+        if int(self.cache_shelf['version']) != int(VERSION) and \
+                self.options['refresh'] != 'none':
+            # with no repo timestamps left, any refresh is a full one.
+            log.warn("Rebuilding shelf version %d as version %d, keeping "
+                     "feedback" % (int(self.cache_shelf['version']),
+                                   int(VERSION)))
+            _clear_all_but_feedback(self.cache_shelf)
+            self.cache_shelf['version'] = VERSION
+
         if int(self.cache_shelf['version']) != int(VERSION):
-            raise RuntimeError("Wrong shelf version %d (code is %d" %
+            raise RuntimeError("Wrong shelf version %d (code is %d); "
+                               "refresh to rebuild it" %
                                (int(self.cache_shelf['version']),
                                 int(VERSION)))
 
@@ -59,6 +107,24 @@ class BugDb(object):
         else:
             self._refresh_from_remotes()
 
+    def feedback(self, fingerprint):
+        """
+        Return a dict of bug key -> True if confirmed, False if
+        rejected, for the traceback fingerprint.
+        """
+        return self.cache_shelf.get(_feedback_key(fingerprint), {})
+
+    def record_feedback(self, fingerprint, bug_key, confirmed):
+        """
+        Record that the bug with key bug_key was confirmed (or, if not
+        confirmed, rejected) as a match for the traceback fingerprint.
+        """
+        if bug_key not in self.cache_shelf:
+            raise KeyError("No such bug in the cache: %s" % bug_key)
+        feedback = self.feedback(fingerprint)
+        feedback[bug_key] = confirmed
+        self.cache_shelf[_feedback_key(fingerprint)] = feedback
+
     def close(self):
         """
         Close the bug db.
@@ -84,8 +150,18 @@ class BugDb(object):
         """
         Update from remote databases, as specified by the refresh
         behavior.
+
+        Each bug db module hands back refresh jobs, one per
+        independent source, as dicts with:
+          'name': for logging
+          'timeout': seconds to wait for the fetch
+          'fetch': callable returning the source's new bugs; it must
+                   not touch the cache, since fetches run concurrently
+          'record': callable taking the fetched bugs and writing them,
+                    and the source's sync timestamp, to the cache
         """
         grouped_db_configs = defaultdict(lambda: [])
+        jobs = []
 
         for db_config in self.db_configs:
             grouped_db_configs[db_config['type'].strip()].append(db_config)
@@ -93,17 +169,238 @@ class BugDb(object):
         for (db_type, db_type_configs) in grouped_db_configs.items():
             if db_type not in SUPPORTED_DB_TYPES:
                 raise RuntimeError("Unsupported db type: %s" % db_type)
-            db_module = SUPPORTED_DB_TYPES[db_type]
-            db_module.update(self.cache_shelf,
-                             db_type_configs,
-                             options=self.options)
+            db_module = _db_module(db_type)
+            jobs.extend(db_module.refresh_jobs(self.cache_shelf,
+                                               db_type_configs,
+                                               options=self.options))
+
+        _run_refresh_jobs(jobs, self.cache_shelf, self.options)
 
 
-def init(profile, db_configs, options):
+def init(profile, db_configs, options, writable=False):
     """
     Initialize a bug database for the specified profile and return it.
+
+    Unless writable, the bug db is opened read-only when not refreshing.
+    """
+    return BugDb(profile, db_configs, options, writable=writable)
+
+
+def index_bugs(cache_shelf, bugs_by_key):
+    """
+    Record bugs_by_key, a dict of bug key -> formatted bug, in the bug
+    index of cache_shelf.
+
+    Formatted bugs should have 'repo', 'state', 'labels' and
+    'updated_at' fields; the latter is an ISO 8601 utc timestamp.
+
+    Only the index shards for the repos in bugs_by_key are read and
+    rewritten.
+    """
+    shards = cache_shelf.get(INDEX_SHARDS_KEY, set())
+    repos = set(bug['repo'] for bug in bugs_by_key.values())
+
+    # start from the existing shards for these repos, dropping the
+    # bugs we're re-indexing, since their state may have changed.
+    shard_indexes = {}
+    for shard in shards:
+        if shard[0] in repos:
+            shard_index = cache_shelf.get(_index_shard_key(shard), {})
+            for key in bugs_by_key:
+                shard_index.pop(key, None)
+            shard_indexes[shard] = shard_index
+
+    for (key, bug) in bugs_by_key.items():
+        shard = (bug['repo'], bug['state'])
+        shard_indexes.setdefault(shard, {})[key] = {
+            'repo': bug['repo'],
+            'state': bug['state'],
+            'labels': bug['labels'],
+            'updated_at': bug['updated_at']}
+
+    for (shard, shard_index) in shard_indexes.items():
+        cache_shelf[_index_shard_key(shard)] = shard_index
+    cache_shelf[INDEX_SHARDS_KEY] = shards | set(shard_indexes)
+
+
+def matches_filters(entry, filters):
+    """
+    Does the bug index entry pass all of filters?
+
+    filters is a dict which may have:
+      'state': only bugs in this state ('open' or 'closed')
+      'repos': only bugs from one of these repos
+      'since': only bugs updated on or after this ISO 8601 date
+      'labels': only bugs having all of these labels
+    Missing or empty filters match everything.
+    """
+    if filters.get('state') and entry['state'] != filters['state']:
+        return False
+    if filters.get('repos') and entry['repo'] not in filters['repos']:
+        return False
+    # ISO 8601 timestamps compare correctly as strings, and a bare
+    # date sorts before any timestamp on that day.
+    if filters.get('since') and entry['updated_at'] < filters['since']:
+        return False
+    if filters.get('labels') and \
+            not set(filters['labels']).issubset(entry['labels']):
+        return False
+    return True
+
+
+def _load_index(cache_shelf, filters):
+    """
+    Return the bug index entries, as a dict of bug key -> entry, from
+    only those index shards that can match the state and repos in
+    filters.
+    """
+    index = {}
+    for (repo, state) in cache_shelf.get(INDEX_SHARDS_KEY, set()):
+        if filters.get('state') and state != filters['state']:
+            continue
+        if filters.get('repos') and repo not in filters['repos']:
+            continue
+        index.update(cache_shelf.get(_index_shard_key((repo, state)), {}))
+    return index
+
+
+def _index_shard_key(shard):
+    """
+    The shelf key for the index shard for a (repo, state).
+    """
+    (repo, state) = shard
+    return str('%s%s:%s' % (INDEX_SHARD_KEY_PREFIX, repo, state))
+
+
+def _run_refresh_jobs(jobs, cache_shelf, options):
+    """
+    Run the fetches for the refresh jobs concurrently, at most
+    config.REFRESH_CONCURRENCY at a time, and record the results of
+    those that finish in time into cache_shelf, one job at a time, as
+    they come in.
+
+    A job that fails or times out just gets a warning; its source
+    keeps whatever (possibly stale) bugs were already cached.
+    """
+    pool = {'jobs': jobs,
+            'options': options,
+            'job_queue': Queue.Queue(),
+            'done_queue': Queue.Queue(),
+            # guards started, finished and abandoned, all sets of job
+            # indexes, except started: job index -> when it started.
+            'lock': threading.Lock(),
+            'started': {},
+            'finished': set(),
+            'abandoned': set()}
+
+    for job_i in range(len(jobs)):
+        pool['job_queue'].put(job_i)
+    for _ in range(min(config.REFRESH_CONCURRENCY, len(jobs))):
+        _start_refresh_worker(pool)
+
+    pending = set(range(len(jobs)))
+    while pending:
+        deadlines = _expire_timed_out_jobs(pool, pending)
+        if not pending:
+            break
+
+        # if no pending job has started yet, a worker is just about to
+        # pick one up; check back shortly.
+        wait = max(0.0, min(deadlines) - time.time()) if deadlines else 0.1
+        try:
+            (job_i, succeeded, result) = pool['done_queue'].get(timeout=wait)
+        except Queue.Empty:
+            continue
+        pending.discard(job_i)
+
+        job = jobs[job_i]
+        if not succeeded:
+            log.warn("Refresh of %s failed, using cached bugs for it: %s" %
+                     (job['name'], result))
+            continue
+
+        job['record'](result)
+        cache_shelf.sync()
+
+
+def _expire_timed_out_jobs(pool, pending):
+    """
+    Give up on any pending jobs that have run past their timeouts,
+    removing them from pending and replacing their workers, and
+    return the deadlines of the pending jobs still running.
+    """
+    jobs = pool['jobs']
+    deadlines = []
+    now = time.time()
+
+    with pool['lock']:
+        for job_i in list(pending):
+            if job_i not in pool['started'] or job_i in pool['finished']:
+                continue
+            deadline = pool['started'][job_i] + jobs[job_i]['timeout']
+            if now < deadline:
+                deadlines.append(deadline)
+                continue
+
+            log.warn("Refresh of %s timed out after %ss, using cached "
+                     "bugs for it." % (jobs[job_i]['name'],
+                                       jobs[job_i]['timeout']))
+            pending.discard(job_i)
+            # the worker can't be interrupted, but it quits once its
+            # fetch returns; start another to keep the pool at size.
+            pool['abandoned'].add(job_i)
+            _start_refresh_worker(pool)
+
+    return deadlines
+
+
+def _start_refresh_worker(pool):
+    """
+    Start a thread fetching queued refresh jobs until there are none
+    left, putting (job index, succeeded, bugs or error) on the pool's
+    done_queue.
+    """
+    thread = threading.Thread(target=_refresh_worker, args=(pool,))
+    # a hung fetch mustn't keep the process alive after we've given up
+    # on it.
+    thread.daemon = True
+    thread.start()
+
+
+def _refresh_worker(pool):
+    """
+    Body of a refresh worker thread; see _start_refresh_worker.
+
+    A worker whose job was abandoned for timing out has been replaced,
+    so it quits rather than take more jobs, keeping the number of
+    fetches going at once within the limit.
     """
-    return BugDb(profile, db_configs, options)
+    while True:
+        try:
+            job_i = pool['job_queue'].get_nowait()
+        except Queue.Empty:
+            return
+        with pool['lock']:
+            pool['started'][job_i] = time.time()
+
+        (succeeded, result) = _fetch(pool['jobs'][job_i], pool['options'])
+
+        with pool['lock']:
+            if job_i in pool['abandoned']:
+                return
+            pool['finished'].add(job_i)
+            pool['done_queue'].put((job_i, succeeded, result))
+
+
+def _fetch(job, options):
+    """
+    Run a refresh job's fetch, returning (succeeded, bugs or error).
+    """
+    try:
+        return (True, job['fetch']())
+    except Exception as err:  # pylint: disable=W0703
+        log.verbose("Refresh of %s raised %r" % (job['name'], err), options)
+        return (False, err)
 
 
 def _cache_fname(profile):
@@ -113,13 +410,55 @@ def _cache_fname(profile):
     return path.join(config.TRACEWHACK_DATA_DIR, '%s.shelf' % profile)
 
 
-def _open_cache_shelf(cache_fname):
+def _open_cache_shelf(cache_fname, readonly=False):
     """
     Open the specified cache file, creating it if needed.
+
+    If readonly, try to open an existing cache without write access,
+    which skips locking and syncing on close; fall back to creating
+    the cache if there isn't one yet.
     """
+    import anydbm
+    import shelve
+
+    if readonly:
+        try:
+            return shelve.open(cache_fname, flag='r', protocol=2)
+        # anydbm.error is a tuple of the backends' exception types
+        except anydbm.error:  # pylint: disable=E0712
+            log.warn("No bug cache at %s yet, creating an empty one." %
+                     cache_fname)
+
     return shelve.open(cache_fname, protocol=2, writeback=False)
 
 
+def _db_module(db_type):
+    """
+    Import and return the module handling bug dbs of type db_type.
+    """
+    # a non-empty fromlist makes __import__ return the module itself
+    # rather than the top level package (importlib is python 2.7+).
+    return __import__(SUPPORTED_DB_TYPES[db_type],
+                      fromlist=['refresh_jobs'])
+
+
+def _clear_all_but_feedback(cache_shelf):
+    """
+    Delete everything from cache_shelf except feedback, which, unlike
+    the bugs, can't be pulled down again.
+    """
+    for key in cache_shelf.keys():
+        if not key.startswith(FEEDBACK_KEY_PREFIX):
+            del cache_shelf[key]
+
+
+def _feedback_key(fingerprint):
+    """
+    The shelf key for feedback on a traceback fingerprint.
+    """
+    return str(FEEDBACK_KEY_PREFIX + fingerprint)
+
+
 def _is_bug_key(key):
     """
     Is this a key for a bug?
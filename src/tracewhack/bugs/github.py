@@ -4,21 +4,42 @@ it properly for the local bug database.
 """
 
 import datetime
+from functools import partial
 import json
 
-import requests
-
 from tracewhack import log
-from tracewhack.config import GITHUB_HOST
+from tracewhack.bugs import db
+from tracewhack.config import GITHUB_HOST, REFRESH_TIMEOUT_SECS
 
 
-def update(cache_shelf, db_configs, options):
+def refresh_jobs(cache_shelf, db_configs, options):
     """
-    Update the cache_shelf from the remote github repos issues, as
-    specified by options['refresh'] behavior.
+    Return refresh jobs (see db.BugDb._refresh_from_remotes) that
+    update the cache_shelf from the remote github repos issues, as
+    specified by options['refresh'] behavior.  There is one job per
+    repo.
     """
     _handle_stale_repos(cache_shelf, db_configs, options)
-    _slurp_repos(cache_shelf, db_configs, options)
+
+    cached_repos_with_ts = _get_repos_with_ts(cache_shelf)
+
+    # taken before fetching anything, so that issues changed while
+    # we're fetching get picked up by the next partial refresh.
+    gh_now = _gh_now()
+
+    jobs = []
+    for db_config in db_configs:
+        repo = db_config['repo']
+        since = cached_repos_with_ts.get(repo, None)
+        jobs.append({'name': 'github:%s' % repo,
+                     'timeout': _timeout(db_config),
+                     'fetch': partial(_slurp, db_config, since, options),
+                     'record': partial(_record_issues,
+                                       cache_shelf=cache_shelf,
+                                       gh_now=gh_now,
+                                       db_config=db_config,
+                                       options=options)})
+    return jobs
 
 
 def _handle_stale_repos(cache_shelf, db_configs, _options):
@@ -37,25 +58,12 @@ def _handle_stale_repos(cache_shelf, db_configs, _options):
         log.warn("Found cached github repos not in config: %s" % stale_repos)
 
 
-def _slurp_repos(cache_shelf, db_configs, options):
-    """
-    Slurp down, either partially or fully, the issues from a set of
-    github repos.
-    """
-    cached_repos_with_ts = _get_repos_with_ts(cache_shelf)
-
-    gh_now = _gh_now()
-
-    for db_config in db_configs:
-        repo = db_config['repo']
-        since = cached_repos_with_ts.get(repo, None)
-        _slurp(cache_shelf, db_config, since, gh_now, options)
-
-
-def _slurp(cache_shelf, db_config, since, gh_now, options):
+def _slurp(db_config, since, options):
     """
     Slurp down the issues, partially or fully, from a single github
-    repo.
+    repo, and return them formatted.
+
+    This doesn't touch the cache, so it's safe to run concurrently.
     """
     if options['refresh'] == 'full':
         since = None
@@ -66,25 +74,26 @@ def _slurp(cache_shelf, db_config, since, gh_now, options):
                 (db_config['repo'],
                  since if since else 'always'),
                  options)
-    issues = _issues(db_config, since, options=options)
-    _record_issues(issues=issues,
-                   cache_shelf=cache_shelf,
-                   gh_now=gh_now,
-                   db_config=db_config,
-                   options=options)
+    return _issues(db_config, since, options=options)
 
 
 def _record_issues(issues, cache_shelf, gh_now, db_config, options):
     """
     Record github issues in the cache.
+
+    The repo's refresh timestamp is written last, so if we die partway
+    through, the next partial refresh re-fetches the same issues.
     """
     # ok, pylint, for now I'm not using this.
     options = options
 
+    issues_by_key = {}
     for issue in issues:
-        issue_key = 'bug:github_%s_%s' % (db_config['repo'],
-                                          issue['id'])
-        cache_shelf[str(issue_key)] = issue
+        issue_key = str('bug:github_%s_%s' % (db_config['repo'],
+                                              issue['id']))
+        cache_shelf[issue_key] = issue
+        issues_by_key[issue_key] = issue
+    db.index_bugs(cache_shelf, issues_by_key)
 
     cached_repos_with_ts = _get_repos_with_ts(cache_shelf)
     cached_repos_with_ts[db_config['repo']] = gh_now
@@ -100,8 +109,14 @@ def _issues(db_config, since, options):
     issues = _just_issues_since(db_config, since, options)
     for issue in issues:
         fmted_issue = {'url': issue['html_url'],
-                        'title': issue['title'],
-                        'id': issue['number']}
+                       'title': issue['title'],
+                       'id': issue['number'],
+                       'repo': db_config['repo'],
+                       'state': issue['state'],
+                       'labels': [label['name']
+                                  for label in issue.get('labels', [])],
+                       'created_at': issue['created_at'],
+                       'updated_at': issue['updated_at']}
         txt = _all_issue_text(issue, db_config, options)
         fmted_issue['text'] = txt
         fmted_issues.append(fmted_issue)
@@ -181,12 +196,10 @@ def _walk_api(full_url, db_config, options):
 
     resp = _raw_api(full_url, db_config, options)
     if not resp.ok:
-        # for now, just bomb out totally, on the theory that we don't
-        # want to deal with stale caches etc.  LATER in the future,
-        # make this a little more robust.
-        err = "Github API error: %s" % resp.text
-        log.error(err)
-        raise RuntimeError(err)
+        # bomb out of this repo's refresh entirely; the caller logs it
+        # and keeps using the repo's existing cache rather than a
+        # partial one.
+        raise RuntimeError("Github API error: %s" % resp.text)
 
     all_jsons.append(resp.text)
 
@@ -209,10 +222,22 @@ def _raw_api(full_url, db_config, options):
     Make a single api call at full_url to the github api, and return
     the json found there.
     """
+    # imported here, since requests is slow to import and only needed
+    # when we actually go over the network.
+    import requests
+
     log.verbose("Hitting github url: %s" % full_url, options)
     return requests.get(full_url,
                         auth=(db_config['api_user'],
-                              db_config['api_password']))
+                              db_config['api_password']),
+                        timeout=_timeout(db_config))
+
+
+def _timeout(db_config):
+    """
+    How many seconds we give a repo's refresh before giving up on it.
+    """
+    return float(db_config.get('timeout', REFRESH_TIMEOUT_SECS))
 
 
 def _get_repos_with_ts(cache_shelf):
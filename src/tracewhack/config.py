@@ -6,3 +6,11 @@ from os import path
 
 TRACEWHACK_DATA_DIR = path.expanduser(path.join('~', '.tracewhack'))
 GITHUB_HOST = "https://api.github.com"
+
+# Default per-source limit on refreshing a remote bug db, overridable
+# with a "timeout" key in the bug db's config.
+REFRESH_TIMEOUT_SECS = 120
+
+# How many remote bug db sources to refresh at once; kept small so big
+# configs don't trip api rate limits.
+REFRESH_CONCURRENCY = 4
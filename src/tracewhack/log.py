@@ -2,14 +2,17 @@
 Logging utilities.
 """
 
-# LATER Right now these are just dumb placeholders.
+import sys
+
+# LATER Right now these are just dumb placeholders.  They write to
+# stderr so they don't get mixed up with machine-readable output.
 
 
 def warn(msg):
     """
     Log a warning.
     """
-    print msg
+    print >> sys.stderr, msg
 
 
 def verbose(msg, options):
@@ -17,11 +20,11 @@ def verbose(msg, options):
     Log only if verbose mode
     """
     if options and options.get('verbose', False):
-        print msg
+        print >> sys.stderr, msg
 
 
 def error(msg):
     """
     Log an error.
     """
-    print msg
+    print >> sys.stderr, msg
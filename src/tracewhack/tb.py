@@ -2,6 +2,7 @@
 Extract tracebacks.
 """
 
+import hashlib
 import re
 
 PY_TRACEBACK_RE = re.compile(
@@ -14,6 +15,16 @@ PY_TRACEBACK_RE = re.compile(
 
 ALL_RES = [PY_TRACEBACK_RE]
 
+# A python stack frame line, capturing the file's base name and the
+# function, but not the line number or the directory, which vary
+# between deploys of the same code.
+PY_FRAME_RE = re.compile(
+    r"""^[ ]+File[ ]"(?:[^"]*[/\\])? # directory, if any
+       ([^"/\\]+)",[ ]line[ ]\d+,[ ] # file base name, line number
+       in[ ](\S+) # function
+    """,
+    re.MULTILINE | re.VERBOSE)
+
 
 def extract_tracebacks(txt):
     """
@@ -45,6 +56,25 @@ def extract_traceback(chunk):
     return None
 
 
+def fingerprint(traceback):
+    """
+    Return a short string identifying traceback, such that the same
+    failure gets the same fingerprint even if line numbers, install
+    paths or the exception message change.
+
+    traceback should be as returned by extract_traceback(s).
+    """
+    traceback = _normalize_linebreaks(traceback)
+    frames = ['%s:%s' % frame for frame in PY_FRAME_RE.findall(traceback)]
+
+    # the error line is the first unindented one after the header
+    error_lines = [line for line in traceback.split('\n')[1:]
+                   if line and not line[0].isspace()]
+    exc_type = error_lines[0].split(':', 1)[0] if error_lines else ''
+
+    return hashlib.sha1('\n'.join(frames + [exc_type])).hexdigest()
+
+
 def _normalize_linebreaks(txt):
     """
     Make all line breaks \n only.
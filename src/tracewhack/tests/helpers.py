@@ -0,0 +1,75 @@
+"""
+Helpers shared by the tests that need a bug cache (test_db,
+test_startup and test_whacker): reading test files and setting up a
+temporary cache.
+"""
+
+import os
+import shutil
+import tempfile
+
+from tracewhack import config
+from tracewhack.bugs import db
+
+# Files holding tracebacks, as used by bugs_from_files.
+TB_FILES = ['simple_tb.txt', 'simple_tb_2.txt', 'contextual_tb.txt']
+
+_ORIG_DATA_DIR = config.TRACEWHACK_DATA_DIR
+
+
+def read_file(fname):
+    """
+    Read a test file from the current directory.
+    """
+    curdir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(curdir, fname)) as fil:
+        return fil.read()
+
+
+def bug_key(fname, repo='org/a'):
+    """
+    The cache key of the bug made by bugs_from_files for the test
+    file fname.
+    """
+    return 'bug:github_%s_%s' % (repo, fname)
+
+
+def bugs_from_files(fnames, repo='org/a'):
+    """
+    Return a dict of bug key -> open bug in repo, one per test file
+    in fnames, with the file as its text.
+    """
+    bugs = {}
+    for fname in fnames:
+        bugs[bug_key(fname, repo)] = {'title': fname,
+                                      'url': 'https://github.com/%s' % repo,
+                                      'repo': repo,
+                                      'state': 'open',
+                                      'labels': [],
+                                      'updated_at': '2012-06-01T12:00:00Z',
+                                      'text': read_file(fname)}
+    return bugs
+
+
+def setup_data_dir(bugs, profile='test'):
+    """
+    Point the cache at a fresh temporary directory, holding the
+    indexed bugs (a dict of bug key -> bug) for profile, and return
+    the directory.
+    """
+    config.TRACEWHACK_DATA_DIR = tempfile.mkdtemp()
+    # no bug db configs, so there's nothing to refresh from
+    with db.init(profile, [], options={'verbose': False,
+                                       'refresh': 'partial'}) as bugsdb:
+        for (key, bug) in bugs.items():
+            bugsdb.cache_shelf[key] = bug
+        db.index_bugs(bugsdb.cache_shelf, bugs)
+    return config.TRACEWHACK_DATA_DIR
+
+
+def teardown_data_dir():
+    """
+    Remove the temporary cache directory.
+    """
+    shutil.rmtree(config.TRACEWHACK_DATA_DIR)
+    config.TRACEWHACK_DATA_DIR = _ORIG_DATA_DIR
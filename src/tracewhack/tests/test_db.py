@@ -0,0 +1,314 @@
+"""
+Tests for functions in the bugs.db module.
+"""
+
+import threading
+import time
+
+from nose.tools import ok_, eq_, assert_raises, with_setup
+
+from tracewhack import config
+from tracewhack.bugs import db
+
+from helpers import setup_data_dir, teardown_data_dir
+
+OPTIONS = {'verbose': False, 'refresh': 'none'}
+REFRESH_OPTIONS = {'verbose': False, 'refresh': 'partial'}
+
+BUGS = {'bug:github_org/a_1': {'title': 'open a',
+                               'repo': 'org/a',
+                               'state': 'open',
+                               'labels': ['crash'],
+                               'updated_at': '2012-06-01T12:00:00Z'},
+        'bug:github_org/a_2': {'title': 'closed a',
+                               'repo': 'org/a',
+                               'state': 'closed',
+                               'labels': [],
+                               'updated_at': '2011-01-01T12:00:00Z'},
+        'bug:github_org/b_1': {'title': 'open b',
+                               'repo': 'org/b',
+                               'state': 'open',
+                               'labels': ['crash', 'ui'],
+                               'updated_at': '2012-07-01T00:00:00Z'}}
+
+
+def _setup_data_dir():
+    """
+    Point the cache at a fresh temporary directory holding BUGS.
+    """
+    setup_data_dir(BUGS)
+
+
+def _titles(filters):
+    """
+    Titles of the cached bugs matching filters.
+    """
+    with db.init('test', [], options=OPTIONS) as bugsdb:
+        return sorted(bug['title'] for bug in bugsdb.bugs(filters=filters))
+
+
+@with_setup(_setup_data_dir, teardown_data_dir)
+def test_bugs_filters():
+    """
+    Test that BugDb.bugs only yields bugs matching the filters.
+    """
+    eq_(['closed a', 'open a', 'open b'], _titles(None))
+    eq_(['closed a', 'open a', 'open b'], _titles({'repos': []}))
+    eq_(['open a', 'open b'], _titles({'state': 'open'}))
+    eq_(['closed a', 'open a'], _titles({'repos': ['org/a']}))
+    eq_(['open a', 'open b'], _titles({'since': '2012-06-01'}))
+    eq_(['open b'], _titles({'since': '2012-06-02'}))
+    eq_(['open a', 'open b'], _titles({'labels': ['crash']}))
+    eq_(['open b'], _titles({'labels': ['crash', 'ui']}))
+    eq_(['open a'], _titles({'state': 'open', 'repos': ['org/a']}))
+    eq_([], _titles({'state': 'closed', 'labels': ['crash']}))
+    eq_([], _titles({'repos': ['org/gone']}))
+
+
+@with_setup(_setup_data_dir, teardown_data_dir)
+def test_index_bugs_reindex():
+    """
+    Test that re-indexing a bug whose state changed moves it between
+    index shards.
+    """
+    closed_b = dict(BUGS['bug:github_org/b_1'], state='closed')
+    with db.init('test', [], options=REFRESH_OPTIONS) as bugsdb:
+        bugsdb.cache_shelf['bug:github_org/b_1'] = closed_b
+        db.index_bugs(bugsdb.cache_shelf, {'bug:github_org/b_1': closed_b})
+
+    eq_(['open a'], _titles({'state': 'open'}))
+    eq_(['closed a', 'open b'], _titles({'state': 'closed'}))
+    eq_(['open b'], _titles({'repos': ['org/b']}))
+
+
+@with_setup(_setup_data_dir, teardown_data_dir)
+def test_bugs_keys():
+    """
+    Test that BugDb.bugs can be restricted to given keys.
+    """
+    with db.init('test', [], options=OPTIONS) as bugsdb:
+        eq_(['open a', 'open b'],
+            sorted(bug['title'] for bug in
+                   bugsdb.bugs(keys=['bug:github_org/a_1',
+                                     'bug:github_org/b_1',
+                                     'bug:github_org/gone_1'])))
+        eq_(['open b'],
+            [bug['title'] for bug in
+             bugsdb.bugs(filters={'repos': ['org/b']},
+                         keys=['bug:github_org/a_1',
+                               'bug:github_org/b_1'])])
+
+
+@with_setup(_setup_data_dir, teardown_data_dir)
+def test_feedback():
+    """
+    Test recording and looking up feedback for fingerprints.
+    """
+    with db.init('test', [], options=OPTIONS, writable=True) as bugsdb:
+        eq_({}, bugsdb.feedback('fp1'))
+        bugsdb.record_feedback('fp1', 'bug:github_org/a_1', True)
+        bugsdb.record_feedback('fp1', 'bug:github_org/a_2', False)
+        bugsdb.record_feedback('fp2', 'bug:github_org/b_1', True)
+        assert_raises(KeyError, bugsdb.record_feedback,
+                      'fp2', 'bug:github_org/gone_1', True)
+
+    with db.init('test', [], options=OPTIONS) as bugsdb:
+        eq_({'bug:github_org/a_1': True,
+             'bug:github_org/a_2': False},
+            bugsdb.feedback('fp1'))
+        eq_({'bug:github_org/b_1': True}, bugsdb.feedback('fp2'))
+
+
+class _LoadSpy(object):
+    """
+    Wraps a shelf's underlying dbm, noting which keys are loaded.
+    """
+
+    def __init__(self, dbm, loaded):
+        self.dbm = dbm
+        self.loaded = loaded
+
+    def __getitem__(self, key):
+        """
+        Note that key was loaded, and load it.
+        """
+        self.loaded.append(key)
+        return self.dbm[key]
+
+    def __contains__(self, key):
+        """
+        Delegate to the wrapped dbm.
+        """
+        return key in self.dbm
+
+    def __iter__(self):
+        """
+        Delegate to the wrapped dbm.
+        """
+        return iter(self.dbm)
+
+    def __len__(self):
+        """
+        Delegate to the wrapped dbm.
+        """
+        return len(self.dbm)
+
+    def __getattr__(self, name):
+        """
+        Delegate to the wrapped dbm.
+        """
+        return getattr(self.dbm, name)
+
+
+@with_setup(_setup_data_dir, teardown_data_dir)
+def test_bugs_skips_non_bug_keys():
+    """
+    Test that walking all bugs never loads feedback or the index.
+    """
+    with db.init('test', [], options=OPTIONS, writable=True) as bugsdb:
+        for fp_i in range(200):
+            bugsdb.record_feedback('fp%d' % fp_i, 'bug:github_org/a_1', True)
+
+    loaded = []
+    with db.init('test', [], options=OPTIONS) as bugsdb:
+        bugsdb.cache_shelf.dict = _LoadSpy(bugsdb.cache_shelf.dict, loaded)
+        eq_(['closed a', 'open a', 'open b'],
+            sorted(bug['title'] for bug in bugsdb.bugs()))
+    eq_(sorted(BUGS), sorted(loaded))
+
+
+@with_setup(_setup_data_dir, teardown_data_dir)
+def test_old_version_rebuilt_on_refresh():
+    """
+    Test that a cache from an older version is refused when not
+    refreshing, and otherwise started over, keeping its feedback.
+    """
+    with db.init('test', [], options=REFRESH_OPTIONS) as bugsdb:
+        bugsdb.record_feedback('fp1', 'bug:github_org/a_1', True)
+        bugsdb.cache_shelf['version'] = db.VERSION - 1
+
+    assert_raises(RuntimeError, db.init('test', [], options=OPTIONS).open)
+
+    with db.init('test', [], options=REFRESH_OPTIONS) as bugsdb:
+        eq_(db.VERSION, bugsdb.cache_shelf['version'])
+        eq_([], list(bugsdb.bugs()))
+        eq_({'bug:github_org/a_1': True}, bugsdb.feedback('fp1'))
+
+
+def _job(name, fetch, recorded, timeout=5.0):
+    """
+    A refresh job that appends name to recorded when recorded.
+    """
+    return {'name': name,
+            'timeout': timeout,
+            'fetch': fetch,
+            'record': lambda bugs: recorded.append((name, bugs))}
+
+
+def _slow_fetch(secs, bugs):
+    """
+    A fetch that takes secs to return bugs.
+    """
+    def fetch():
+        time.sleep(secs)
+        return bugs
+    return fetch
+
+
+def _failing_fetch():
+    """
+    A fetch that blows up.
+    """
+    raise RuntimeError("Github API error: boom")
+
+
+@with_setup(_setup_data_dir, teardown_data_dir)
+def test_run_refresh_jobs():
+    """
+    Test that refresh jobs run concurrently and that a failing or
+    hung source doesn't stop the others from being recorded.
+    """
+    recorded = []
+    jobs = [_job('slow_1', _slow_fetch(0.3, [1]), recorded),
+            _job('failing', _failing_fetch, recorded),
+            _job('hung', _slow_fetch(5.0, [2]), recorded, timeout=0.1),
+            _job('slow_2', _slow_fetch(0.3, [3]), recorded)]
+
+    start = time.time()
+    with db.init('test', [], options=REFRESH_OPTIONS) as bugsdb:
+        # pylint: disable=W0212
+        db._run_refresh_jobs(jobs, bugsdb.cache_shelf, REFRESH_OPTIONS)
+    elapsed = time.time() - start
+
+    eq_([('slow_1', [1]), ('slow_2', [3])], sorted(recorded))
+    ok_(elapsed < 0.6, "refresh took %.3fs, not concurrent?" % elapsed)
+
+
+@with_setup(_setup_data_dir, teardown_data_dir)
+def test_run_refresh_jobs_concurrency():
+    """
+    Test that no more than config.REFRESH_CONCURRENCY fetches run at
+    once, and that a hung fetch doesn't hold up the queued ones.
+    """
+    recorded = []
+    jobs = [_job('hung', _slow_fetch(5.0, [0]), recorded, timeout=0.1)] + \
+        [_job('slow_%d' % job_i, _slow_fetch(0.2, [job_i]), recorded)
+         for job_i in range(1, 5)]
+
+    orig_concurrency = config.REFRESH_CONCURRENCY
+    config.REFRESH_CONCURRENCY = 2
+    start = time.time()
+    try:
+        with db.init('test', [], options=REFRESH_OPTIONS) as bugsdb:
+            # pylint: disable=W0212
+            db._run_refresh_jobs(jobs, bugsdb.cache_shelf, REFRESH_OPTIONS)
+    finally:
+        config.REFRESH_CONCURRENCY = orig_concurrency
+    elapsed = time.time() - start
+
+    eq_(['slow_1', 'slow_2', 'slow_3', 'slow_4'],
+        sorted(name for (name, _bugs) in recorded))
+    # 4 * 0.2s of fetches, 2 at a time
+    ok_(0.4 <= elapsed < 0.8, "refresh took %.3fs" % elapsed)
+
+
+@with_setup(_setup_data_dir, teardown_data_dir)
+def test_run_refresh_jobs_abandoned_worker():
+    """
+    Test that a worker whose fetch timed out doesn't pick up more jobs
+    once the fetch returns, on top of the worker that replaced it.
+    """
+    lock = threading.Lock()
+    counts = {'running': 0, 'peak': 0}
+
+    def counted_fetch():
+        """
+        A fetch that keeps track of how many are running at once.
+        """
+        with lock:
+            counts['running'] += 1
+            counts['peak'] = max(counts['peak'], counts['running'])
+        time.sleep(0.1)
+        with lock:
+            counts['running'] -= 1
+        return []
+
+    recorded = []
+    # the hung fetch returns partway through the queued ones; it isn't
+    # counted, since it's abandoned and can't be interrupted.
+    jobs = [_job('hung', _slow_fetch(0.3, [0]), recorded, timeout=0.1)] + \
+        [_job('counted_%d' % job_i, counted_fetch, recorded)
+         for job_i in range(6)]
+
+    orig_concurrency = config.REFRESH_CONCURRENCY
+    config.REFRESH_CONCURRENCY = 1
+    try:
+        with db.init('test', [], options=REFRESH_OPTIONS) as bugsdb:
+            # pylint: disable=W0212
+            db._run_refresh_jobs(jobs, bugsdb.cache_shelf, REFRESH_OPTIONS)
+    finally:
+        config.REFRESH_CONCURRENCY = orig_concurrency
+
+    eq_(['counted_%d' % job_i for job_i in range(6)],
+        sorted(name for (name, _bugs) in recorded))
+    eq_(1, counts['peak'])
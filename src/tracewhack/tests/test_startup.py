@@ -0,0 +1,89 @@
+"""
+Startup-time benchmark for cache-only queries.
+
+tw.py is typically run once per exception email, so interpreter and
+import time are a large part of its total cost.
+"""
+
+import os
+import subprocess
+import sys
+
+from nose.tools import ok_, eq_
+
+from helpers import TB_FILES, bugs_from_files, read_file, \
+    setup_data_dir, teardown_data_dir
+
+# Seconds a cache-only whack may take, measured in-process from
+# before importing tracewhack until results are printed.  Generous,
+# since this runs on loaded CI boxes; the point is to catch someone
+# reintroducing an eager import of the network stack.
+STARTUP_BUDGET_SECS = 0.5
+
+# Modules a cache-only query must never import.
+HEAVY_MODULES = ['requests', 'tracewhack.bugs.github']
+
+# Run with the cache directory, then HEAVY_MODULES, as arguments.
+BENCH_SCRIPT = """
+import sys
+import time
+
+start = time.time()
+
+from tracewhack import config
+config.TRACEWHACK_DATA_DIR = sys.argv[1]
+from tracewhack import whacker
+
+whacker.whack(traceback_txt=sys.stdin.read(),
+              config={'profile': 'bench', 'bugdbs': []},
+              options={'verbose': False,
+                       'refresh': 'none',
+                       'num_results': 5})
+
+print '%f %s' % (time.time() - start,
+                 ' '.join(m for m in sys.argv[2:] if m in sys.modules))
+"""
+
+
+def _src_dir():
+    """
+    The directory containing the tracewhack package.
+    """
+    return os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+
+
+def test_cache_only_startup():
+    """
+    A refresh=none whack against an existing cache stays within
+    budget and never touches the network modules.
+    """
+    data_dir = setup_data_dir(bugs_from_files(TB_FILES), profile='bench')
+    try:
+        env = dict(os.environ)
+        env['PYTHONPATH'] = _src_dir()
+        proc = subprocess.Popen([sys.executable, '-c', BENCH_SCRIPT,
+                                 data_dir] + HEAVY_MODULES,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                env=env)
+        (out, err) = proc.communicate(read_file('simple_tb.txt'))
+    finally:
+        teardown_data_dir()
+
+    eq_(0, proc.returncode, err)
+    # nothing logged means the existing cache was opened read-only,
+    # rather than falling back to creating a writable one.
+    eq_('', err)
+    # and the matching bug was actually scored.
+    ok_('simple_tb.txt' in out, out)
+
+    fields = out.strip().split('\n')[-1].split()
+    elapsed = float(fields[0])
+    loaded = fields[1:]
+
+    eq_([], loaded)
+    ok_(elapsed < STARTUP_BUDGET_SECS,
+        "cache-only whack took %.3fs (budget %.3fs)" %
+        (elapsed, STARTUP_BUDGET_SECS))
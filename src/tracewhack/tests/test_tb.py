@@ -6,7 +6,7 @@ import os
 
 from nose.tools import ok_, eq_
 
-from tracewhack.tb import extract_traceback, extract_tracebacks
+from tracewhack.tb import extract_traceback, extract_tracebacks, fingerprint
 
 
 def eq_strip_(str_or_list_1, str_or_list_2):
@@ -104,3 +104,25 @@ def test_extract_tracebacks():
     ok_(read_file('simple_tb_extracted.txt').strip() in tbs)
     ok_(read_file('contextual_tb_extracted.txt').strip() in tbs)
     ok_(read_file('simple_tb_2_extracted.txt').strip() in tbs)
+
+
+def test_fingerprint():
+    """
+    Test that fingerprints ignore line numbers, directories, line
+    breaks and exception messages, but not the frames or exception
+    type.
+    """
+    tb_txt = read_file('simple_tb_extracted.txt')
+    tb_fp = fingerprint(tb_txt)
+
+    eq_(tb_fp, fingerprint(read_file_rn('simple_tb_extracted.txt')))
+    eq_(tb_fp, fingerprint(tb_txt.replace('line 376', 'line 380')))
+    eq_(tb_fp, fingerprint(tb_txt.replace('/cryptstorage/deploy/', '/srv/')))
+    eq_(tb_fp, fingerprint(tb_txt.replace('add_reminder 500',
+                                          'add_reminder 502')))
+
+    ok_(tb_fp != fingerprint(tb_txt.replace('APIException:',
+                                            'ValueError:')))
+    ok_(tb_fp != fingerprint(tb_txt.replace('in call_safely',
+                                            'in call_unsafely')))
+    ok_(tb_fp != fingerprint(read_file('simple_tb_2_extracted.txt')))
@@ -0,0 +1,95 @@
+"""
+Tests for functions in the whacker module.
+"""
+
+from nose.tools import ok_, eq_, assert_raises, with_setup
+
+from tracewhack import whacker
+from tracewhack.bugs import db
+from tracewhack.tb import extract_tracebacks, fingerprint
+
+from helpers import TB_FILES, bug_key, bugs_from_files, read_file, \
+    setup_data_dir, teardown_data_dir
+
+OPTIONS = {'verbose': False, 'refresh': 'none', 'num_results': 5}
+CONFIG = {'profile': 'test', 'bugdbs': []}
+
+
+def _setup_data_dir():
+    """
+    Point the cache at a fresh temporary directory holding one bug
+    per file in TB_FILES.
+    """
+    setup_data_dir(bugs_from_files(TB_FILES))
+
+
+@with_setup(_setup_data_dir, teardown_data_dir)
+def test_matches():
+    """
+    Test that matches are ranked, carry the matched tracebacks, and
+    take feedback into account.
+    """
+    tb_txt = read_file('simple_tb_2.txt')
+    tb = extract_tracebacks(tb_txt)[0]
+
+    found = list(whacker.matches(tb_txt, CONFIG, OPTIONS))
+    eq_(len(TB_FILES), len(found))
+    eq_(bug_key('simple_tb_2.txt'), found[0].bug_id)
+    eq_(1.0, found[0].score)
+    eq_(tb, found[0].tb)
+    eq_(tb, found[0].bug_tb)
+    eq_(sorted(found, key=lambda match: -match.score), found)
+
+    with db.init('test', [], options=OPTIONS, writable=True) as bugsdb:
+        bugsdb.record_feedback(fingerprint(tb),
+                               bug_key('simple_tb.txt'), True)
+        bugsdb.record_feedback(fingerprint(tb),
+                               bug_key('simple_tb_2.txt'), False)
+
+    with whacker.Whacker(CONFIG, OPTIONS) as whacker_o:
+        found = list(whacker_o.matches(tb_txt))
+        eq_([bug_key('simple_tb.txt'), bug_key('contextual_tb.txt')],
+            [match.bug_id for match in found])
+        eq_(1.0, found[0].score)
+        ok_(found[1].score < 1.0)
+
+        # the same Whacker can match again without reloading
+        eq_(found, list(whacker_o.matches(tb_txt)))
+
+    assert_raises(ValueError, whacker.matches,
+                  read_file('not_a_tb.txt'), CONFIG, OPTIONS)
+
+
+@with_setup(_setup_data_dir, teardown_data_dir)
+def test_whacker_record_feedback():
+    """
+    Test that feedback recorded through a Whacker shows up in its
+    later matches.
+    """
+    tb_txt = read_file('simple_tb_2.txt')
+
+    with whacker.Whacker(CONFIG, OPTIONS) as whacker_o:
+        def bug_ids():
+            """
+            The ids of the bugs whacker_o matches to tb_txt, in order.
+            """
+            return [match.bug_id for match in whacker_o.matches(tb_txt)]
+
+        eq_(bug_key('simple_tb_2.txt'), bug_ids()[0])
+
+        whacker_o.record_feedback(tb_txt, bug_key('simple_tb.txt'), True)
+        eq_(bug_key('simple_tb.txt'), bug_ids()[0])
+
+        whacker_o.record_feedback(tb_txt, bug_key('simple_tb_2.txt'), False)
+        ok_(bug_key('simple_tb_2.txt') not in bug_ids())
+
+
+def test_score_bugs_no_overlap():
+    """
+    Test that a bug whose tracebacks share nothing with the input
+    still gets a Match with the pair that was compared.
+    """
+    bug = {'global_id': 'bug:github_org/a_1'}
+    # pylint: disable=W0212
+    eq_([whacker.Match('bug:github_org/a_1', bug, 0.0, 'aaa', 'zzz')],
+        whacker._score_bugs(['aaa'], [(bug, ['zzz'])]))
@@ -2,38 +2,199 @@
 Facade for internal functions.
 """
 
-from collections import defaultdict
+from collections import namedtuple
+from contextlib import closing
 import difflib
+from itertools import islice
+import json
 import os
+import sys
 from textwrap import dedent
 
 from tracewhack import log
 from tracewhack.config import TRACEWHACK_DATA_DIR
 from tracewhack.bugs import db
-from tracewhack.tb import extract_tracebacks
+from tracewhack.tb import extract_tracebacks, fingerprint
 
+# A bug matched to an input traceback: bug_id is the bug's global id,
+# tb the input traceback and bug_tb the bug's traceback that matched
+# best.
+Match = namedtuple('Match', ['bug_id', 'bug', 'score', 'tb', 'bug_tb'])
 
-def whack(traceback_txt, config, options):
+OUTPUT_FORMATS = ['text', 'json', 'jsonl']
+
+
+class Whacker(object):
     """
-    Extract any traceback from traceback_txt and attempt to match it
-    to a bug.
+    Matches tracebacks against an open bug db.
+
+    Meant for matching many tracebacks in one process: the bug db is
+    opened (and refreshed) once, and the bugs' tracebacks are
+    extracted once, on the first match.  That snapshot of the bugs is
+    never refreshed; open a new Whacker to pick up bug db changes.
+
+    Feedback should be recorded through the Whacker's own
+    record_feedback, which reopens its bug db so later matches see
+    it.  Feedback recorded elsewhere (another process, or the module
+    level record_feedback) isn't seen until the Whacker is reopened.
     """
-    _ensure_tracewhack_data_dir()
 
-    tbs = extract_tracebacks(traceback_txt)
-    if not tbs:
-        err = "Could not extract a traceback"
-        log.error(err)
-        raise ValueError(err)
+    def __init__(self, config, options):
+        self.config = config
+        self.options = options
+        self.bugsdb = None
+        self._bugs_with_tbs = None
+
+    def matches(self, traceback_txt):
+        """
+        Return a generator of Matches for the traceback(s) in
+        traceback_txt, best first.  Raises ValueError right away if
+        there aren't any tracebacks.
+
+        Bugs previously confirmed as matches (see record_feedback)
+        are yielded first, with a score of 1.0, before any scoring
+        happens, so callers wanting only a few results may not pay
+        for scoring at all.  Rejected bugs are left out.
+        """
+        return self.tb_matches(_extract_tracebacks_or_bomb(traceback_txt))
+
+    def tb_matches(self, tbs):
+        """
+        Generator of Matches for the already extracted tracebacks tbs,
+        best first.  See matches.
+        """
+        feedback = _feedback(self.bugsdb, tbs)
+        confirmed_keys = [key for (key, confirmed) in feedback.items()
+                          if confirmed]
+        for bug in self.bugsdb.bugs(filters=self.options.get('filters'),
+                                    keys=confirmed_keys):
+            yield _confirmed_match(bug, tbs)
+
+        bugs_with_tbs = [(bug, bug_tbs) for (bug, bug_tbs)
+                         in self.bugs_with_tbs()
+                         if bug['global_id'] not in feedback]
+        for match in _score_bugs(tbs, bugs_with_tbs):
+            yield match
+
+    def bugs_with_tbs(self):
+        """
+        Return (bug, tbs) for only those bugs having tbs, extracting
+        them the first time through.
+        """
+        if self._bugs_with_tbs is None:
+            self._bugs_with_tbs = _bugs_with_tbs(self.bugsdb, self.options)
+        return self._bugs_with_tbs
+
+    def record_feedback(self, traceback_txt, bug_key, confirmed):
+        """
+        Record feedback on a match; see the module level
+        record_feedback.  Later matches from this Whacker take it into
+        account.
+        """
+        tbs = _extract_tracebacks_or_bomb(traceback_txt)
+
+        # our own handle may be read-only, and won't see writes made
+        # through another one, so write through a fresh writable one
+        # and then reopen ours.  The bugs themselves don't change, so
+        # there's no need to refresh again or re-extract their tbs.
+        self.close()
+        options = dict(self.options, refresh='none')
+        try:
+            with db.init(self.config['profile'],
+                         self.config['bugdbs'],
+                         options=options,
+                         writable=True) as bugsdb:
+                _record_feedback(bugsdb, tbs, bug_key, confirmed)
+        finally:
+            self._open_bugsdb(options)
+
+    def open(self):
+        """
+        Open the bug db, refreshing from remote dbs as specified by
+        the refresh option.
+        """
+        _ensure_tracewhack_data_dir()
+        self._open_bugsdb(self.options)
+
+    def _open_bugsdb(self, options):
+        """
+        Open our bug db with options.
+        """
+        self.bugsdb = db.init(self.config['profile'],
+                              self.config['bugdbs'],
+                              options=options)
+        self.bugsdb.open()
 
-    bugs_with_tbs = _bugs_with_tbs(config, options)
-    bug_and_scores = _score_bugs(tbs, bugs_with_tbs)
-    print "Displaying best matches:"
+    def close(self):
+        """
+        Close the bug db.
+        """
+        if self.bugsdb:
+            self.bugsdb.close()
 
-    for (match_i, (bug, score)) in enumerate(bug_and_scores):
-        if match_i >= options['num_results']:
-            break
-        print _fmt_bug(bug, score)
+    def __enter__(self):
+        """
+        Make the Whacker ready to match, returning it.
+        """
+        self.open()
+        return self
+
+    def __exit__(self, extype, value, traceback):
+        """
+        Release the Whacker's hold on the bug cache.
+        """
+        self.close()
+
+
+def matches(traceback_txt, config, options):
+    """
+    Return a generator of Matches for the traceback(s) in
+    traceback_txt, best first.  See Whacker.matches.
+
+    To match several tracebacks, use a Whacker instead, so the bug db
+    isn't reloaded for each one.
+
+    The bug db stays open until the generator is exhausted or closed,
+    so callers that stop early should close() it.
+    """
+    # extract before touching the bug db, so bad input fails fast
+    tbs = _extract_tracebacks_or_bomb(traceback_txt)
+    return _matches(tbs, config, options)
+
+
+def _matches(tbs, config, options):
+    """
+    Generator of Matches for tbs, using a Whacker that lives as long
+    as the generator does.
+    """
+    with Whacker(config, options) as whacker:
+        for match in whacker.tb_matches(tbs):
+            yield match
+
+
+def whack(traceback_txt, config, options):
+    """
+    Extract any traceback from traceback_txt and attempt to match it
+    to a bug, printing the best matches in options['format'] (see
+    OUTPUT_FORMATS; defaults to 'text').
+    """
+    fmt = options.get('format', 'text')
+    # closed explicitly, since we stop early and it holds the bug db
+    with closing(matches(traceback_txt, config, options)) as all_matches:
+        top_matches = islice(all_matches, options['num_results'])
+
+        if fmt == 'json':
+            print json.dumps([_match_dict(match) for match in top_matches],
+                             indent=2)
+        elif fmt == 'jsonl':
+            for match in top_matches:
+                print json.dumps(_match_dict(match))
+                # consumers may act on each match as it comes
+                sys.stdout.flush()
+        else:
+            print "Displaying best matches:"
+            for match in top_matches:
+                print _fmt_bug(match.bug, match.score)
 
 
 def _fmt_bug(bug, score):
@@ -43,22 +204,74 @@ def _fmt_bug(bug, score):
     fmted = dedent("""
                    {title}
                    Url: {url}
+                   Id: {global_id}
                    Score: [{score}/1.0]""").format(title=bug['title'],
                                                    url=bug['url'],
+                                                   global_id=bug['global_id'],
                                                    score=score)
     return fmted
 
 
+def _match_dict(match):
+    """
+    Format a match as a dict for json output.
+    """
+    return {'bug_id': match.bug_id,
+            'title': match.bug['title'],
+            'url': match.bug['url'],
+            'score': match.score,
+            'traceback': match.tb,
+            'bug_traceback': match.bug_tb}
+
+
+def record_feedback(traceback_txt, config, options, bug_key, confirmed):
+    """
+    Record that the bug with key (global id) bug_key is, if confirmed,
+    or is not, the bug behind the traceback(s) in traceback_txt, so
+    later whacks of the same traceback can take it into account.
+    """
+    _ensure_tracewhack_data_dir()
+
+    tbs = _extract_tracebacks_or_bomb(traceback_txt)
+
+    # no need to go to the network just to write down feedback
+    options = dict(options, refresh='none')
+
+    with db.init(config['profile'],
+                 config['bugdbs'],
+                 options=options,
+                 writable=True) as bugsdb:
+        _record_feedback(bugsdb, tbs, bug_key, confirmed)
+
+    print "Recorded %s as %s for %d traceback(s)." % (
+        bug_key, 'confirmed' if confirmed else 'rejected', len(tbs))
+
+
+def _record_feedback(bugsdb, tbs, bug_key, confirmed):
+    """
+    Record feedback on bug_key for each of tbs in the writable bugsdb.
+    """
+    for traceback in tbs:
+        try:
+            bugsdb.record_feedback(fingerprint(traceback),
+                                   bug_key,
+                                   confirmed)
+        except KeyError as err:
+            log.error(err.args[0])
+            raise
+
+
 def _score_bugs(tbs, bugs_with_tbs):
     """
     Score bugs by how closely their tracebacks match any tracebacks
     we've pulled from the input.  In the case of multiple tbs per
-    input / bug, we use the highest score.
+    input / bug, we use the highest score, or the first pair compared
+    if they all score 0.0.
 
-    Return the bugs sorted by score.
+    Return Matches sorted by score.
     """
     bugs_by_id = {}
-    score_by_id = defaultdict(lambda: 0.0)
+    best_by_id = {}
 
     for (bug, bug_tbs) in bugs_with_tbs:
         bugs_by_id[bug['global_id']] = bug
@@ -68,14 +281,18 @@ def _score_bugs(tbs, bugs_with_tbs):
             for bug_tb in bug_tbs:
                 bug_id = bug['global_id']
                 score = _score(traceback, bug_tb)
-                score_by_id[bug_id] = max(score_by_id[bug_id], score)
+                if bug_id not in best_by_id or \
+                        score > best_by_id[bug_id][0]:
+                    best_by_id[bug_id] = (score, traceback, bug_tb)
 
     score_and_ids = [(score, bug_id)
-                     for (bug_id, score)
-                     in score_by_id.items()]
+                     for (bug_id, (score, _tb, _bug_tb))
+                     in best_by_id.items()]
     score_and_ids.sort()
     score_and_ids.reverse()
-    return [(bugs_by_id[bug_id], score) for (score, bug_id) in score_and_ids]
+    return [Match(bug_id, bugs_by_id[bug_id], score,
+                  best_by_id[bug_id][1], best_by_id[bug_id][2])
+            for (score, bug_id) in score_and_ids]
 
 
 def _score(tba, tbb):
@@ -86,23 +303,62 @@ def _score(tba, tbb):
     return difflib.SequenceMatcher(a=tba, b=tbb).ratio()
 
 
-def _bugs_with_tbs(config, options):
+def _bugs_with_tbs(bugsdb, options):
     """
     Return (bug, tbs) for only those bugs having tbs.
     """
     bugs_with_tbs = []
 
-    with db.init(config['profile'],
-                 config['bugdbs'],
-                 options=options) as bugsdb:
-        for bug in bugsdb.bugs():
-            tbs = extract_tracebacks(bug['text'])
-            if tbs:
-                bugs_with_tbs.append((bug, tbs))
+    for bug in bugsdb.bugs(filters=options.get('filters')):
+        tbs = extract_tracebacks(bug['text'])
+        if tbs:
+            bugs_with_tbs.append((bug, tbs))
 
     return bugs_with_tbs
 
 
+def _confirmed_match(bug, tbs):
+    """
+    Return a Match for a bug confirmed as matching one of tbs, pairing
+    up tracebacks by fingerprint where we can.
+    """
+    bug_tbs = extract_tracebacks(bug['text'])
+    bug_tbs_by_fp = dict((fingerprint(bug_tb), bug_tb) for bug_tb in bug_tbs)
+    for traceback in tbs:
+        if fingerprint(traceback) in bug_tbs_by_fp:
+            return Match(bug['global_id'], bug, 1.0,
+                         traceback, bug_tbs_by_fp[fingerprint(traceback)])
+    return Match(bug['global_id'], bug, 1.0,
+                 tbs[0], bug_tbs[0] if bug_tbs else None)
+
+
+def _feedback(bugsdb, tbs):
+    """
+    Return a dict of bug key -> True if confirmed, False if rejected,
+    merging the recorded feedback for all of tbs.  A confirmation for
+    any of tbs wins over a rejection for another.
+    """
+    merged = {}
+    for traceback in tbs:
+        feedback = bugsdb.feedback(fingerprint(traceback))
+        for (key, confirmed) in feedback.items():
+            merged[key] = merged.get(key, False) or confirmed
+    return merged
+
+
+def _extract_tracebacks_or_bomb(traceback_txt):
+    """
+    Extract the tracebacks from traceback_txt, raising an error if
+    there aren't any.
+    """
+    tbs = extract_tracebacks(traceback_txt)
+    if not tbs:
+        err = "Could not extract a traceback"
+        log.error(err)
+        raise ValueError(err)
+    return tbs
+
+
 def _ensure_tracewhack_data_dir():
     """
     If TRACEWHACK_DATA_DIR doesn't exist, create it, and error out if
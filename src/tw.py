@@ -4,6 +4,7 @@
 Main driver script for tracewhack.
 """
 
+import datetime
 import json
 from optparse import OptionParser
 import sys
@@ -18,7 +19,12 @@ def _extract_options(optparse_options):
     """
     return {'verbose': optparse_options.verbose,
             'refresh': optparse_options.refresh,
-            'num_results': optparse_options.num_results}
+            'num_results': optparse_options.num_results,
+            'format': optparse_options.format,
+            'filters': {'state': optparse_options.state,
+                        'repos': optparse_options.repos,
+                        'since': optparse_options.since,
+                        'labels': optparse_options.labels}}
 
 
 def main():
@@ -49,6 +55,55 @@ def main():
     parser.add_option("-n", "--num-results", dest="num_results",
                       default=5, type="int",
                       help="Show the top n results (defaults to 5)")
+    parser.add_option("--format", dest="format",
+                      default='text', type="choice",
+                      choices=whacker.OUTPUT_FORMATS,
+                      help=dedent("""
+                                  Output format.  Valid options are:
+                                  'text' (default); 'json': a list of
+                                  matches; 'jsonl': one match per
+                                  line, in rank order.  Previously
+                                  confirmed matches are printed right
+                                  away, the rest once scoring
+                                  finishes.
+                                  """).strip())
+    parser.add_option("--state", dest="state",
+                      help="Only match bugs in this state: 'open' or "
+                      "'closed'.")
+    parser.add_option("--repo", dest="repos",
+                      action="append", default=[],
+                      help=dedent("""
+                                  Only match bugs from this repo.  May
+                                  be given more than once.
+                                  """).strip())
+    parser.add_option("--since", dest="since",
+                      help=dedent("""
+                                  Only match bugs updated on or after
+                                  this date (YYYY-MM-DD).
+                                  """).strip())
+    parser.add_option("--label", dest="labels",
+                      action="append", default=[],
+                      help=dedent("""
+                                  Only match bugs having this label.
+                                  May be given more than once; bugs
+                                  must have all the labels.
+                                  """).strip())
+    parser.add_option("--confirm", dest="confirm",
+                      metavar="BUG_ID",
+                      help=dedent("""
+                                  Instead of searching, record that the
+                                  bug with this Id is a match for the
+                                  target traceback, so it's returned
+                                  first from now on.
+                                  """).strip())
+    parser.add_option("--reject", dest="reject",
+                      metavar="BUG_ID",
+                      help=dedent("""
+                                  Instead of searching, record that the
+                                  bug with this Id is not a match for
+                                  the target traceback, so it's left
+                                  out from now on.
+                                  """).strip())
     parser.add_option("-v", "--verbose", dest="verbose",
                       default=False, action="store_true",
                       help="Print a lot of extra information.")
@@ -60,6 +115,17 @@ def main():
     legal_refresh = ['partial', 'full', 'none']
     if options.refresh not in legal_refresh:
         parser.error("refresh param must be one of %s" % legal_refresh)
+    legal_state = [None, 'open', 'closed']
+    if options.state not in legal_state:
+        parser.error("state param must be one of %s" % legal_state[1:])
+    if options.since:
+        try:
+            datetime.datetime.strptime(options.since, '%Y-%m-%d')
+        except ValueError:
+            parser.error("since param must be a date like 2012-06-30")
+
+    if options.confirm and options.reject:
+        parser.error("Only one of confirm and reject may be given.")
 
     config_fname = args[0]
     config = None
@@ -75,9 +141,16 @@ def main():
     else:
         traceback_txt = sys.stdin.read()
 
-    whacker.whack(traceback_txt=traceback_txt,
-                  config=config,
-                  options=_extract_options(options))
+    if options.confirm or options.reject:
+        whacker.record_feedback(traceback_txt=traceback_txt,
+                                config=config,
+                                options=_extract_options(options),
+                                bug_key=options.confirm or options.reject,
+                                confirmed=bool(options.confirm))
+    else:
+        whacker.whack(traceback_txt=traceback_txt,
+                      config=config,
+                      options=_extract_options(options))
 
 
 if __name__ == '__main__':